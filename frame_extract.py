@@ -1,23 +1,111 @@
 import os
-import pysrt
-import tempfile
 import argparse
 import random
-from moviepy import VideoFileClip
-from Katna.video import Video
-from Katna.writer import KeyFrameDiskWriter
-from PIL import Image
+import heapq
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import av
+import cv2
 import numpy as np
+from transcript_modify import parse_srt, format_srt_time
+
+HISTOGRAM_BINS = 64
+# Decode forward instead of seeking when the next chunk starts at most this
+# many seconds after the current stream position
+MAX_SEQUENTIAL_GAP = 10.0
+
+class FrameCursor:
+    """
+    Sequential reader over the video stream of an open PyAV container.
+    Subtitle chunks usually follow each other, so decoding continues where
+    the previous chunk stopped and the container is only seeked when needed.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        # Last frame before the current position, and its histogram once computed
+        self.prev_frame = None
+        self.prev_hist = None
+        self._frames = None
+        self._pending = None
+
+    def seek(self, time):
+        self.container.seek(int(time * av.time_base))
+        self._frames = self.container.decode(video=0)
+        self._pending = None
+        self.prev_frame = None
+        self.prev_hist = None
+
+    def advance_to(self, time):
+        # The pending frame is the first one past the previous chunk; keep
+        # decoding from it when it is at or shortly before `time`
+        if (
+            self._pending is None
+            or self._pending.time > time
+            or time - self._pending.time > MAX_SEQUENTIAL_GAP
+        ):
+            self.seek(time)
+
+    def push_back(self, frame):
+        self._pending = frame
+
+    def frames(self):
+        if self._pending is not None:
+            frame, self._pending = self._pending, None
+            yield frame
+        # Plain loop rather than `yield from`: closing this generator must
+        # not close the shared decode generator
+        for frame in self._frames:
+            yield frame
+
+def luma_histogram(frame):
+    luma = frame.to_ndarray(format="gray")
+    hist = np.bincount(luma.ravel() >> 2, minlength=HISTOGRAM_BINS)
+    return hist / luma.size
+
+def extract_chunk_frames(cursor, start_time, end_time, frames_to_extract=5):
+    """
+    Decode [start_time, end_time) once through a FrameCursor and return the
+    `frames_to_extract` frames whose luma histogram changes the most from
+    the previous frame, as BGR arrays in time order.
+    """
+    cursor.advance_to(start_time)
+    prev_frame, prev_hist = cursor.prev_frame, cursor.prev_hist
+    top_frames = []
+    for frame_index, frame in enumerate(cursor.frames()):
+        if frame.time is None:
+            continue
+        if frame.time >= end_time:
+            cursor.push_back(frame)
+            break
+
+        # Pre-roll frames are only kept as a reference; the histogram of the
+        # last one is computed lazily when the first in-chunk frame needs it
+        if frame.time < start_time:
+            prev_frame, prev_hist = frame, None
+            continue
 
-def srt_time_to_seconds(srt_time):
-    return (
-        srt_time.hours * 3600
-        + srt_time.minutes * 60
-        + srt_time.seconds
-        + srt_time.milliseconds / 1000
-    )
+        if prev_hist is None and prev_frame is not None:
+            prev_hist = luma_histogram(prev_frame)
+        hist = luma_histogram(frame)
+        score = float(np.abs(hist - prev_hist).sum()) if prev_hist is not None else 0.0
+        prev_frame, prev_hist = frame, hist
+
+        entry = (score, frame_index, frame)
+        if len(top_frames) < frames_to_extract:
+            heapq.heappush(top_frames, entry)
+        elif score > top_frames[0][0]:
+            heapq.heapreplace(top_frames, entry)
 
-def process_subtitle_chunk(clip, sub, chunk_index, output_dir, frames_to_extract=5):
+    cursor.prev_frame, cursor.prev_hist = prev_frame, prev_hist
+
+    # Only the selected frames are converted to full-color arrays
+    return [
+        frame.to_ndarray(format="bgr24")
+        for _, _, frame in sorted(top_frames, key=lambda e: e[1])
+    ]
+
+def process_subtitle_chunk(cursor, start_time, end_time, text, chunk_index, output_dir, frames_to_extract=5):
     chunk_folder_name = f"chunk_{chunk_index:03d}"
     chunk_folder = os.path.join(output_dir, chunk_folder_name)
     os.makedirs(chunk_folder, exist_ok=True)
@@ -25,99 +113,117 @@ def process_subtitle_chunk(clip, sub, chunk_index, output_dir, frames_to_extract
     keyframes_folder = os.path.join(chunk_folder, "keyframes")
     os.makedirs(keyframes_folder, exist_ok=True)
 
-    with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as tmp:
-        temp_chunk_path = tmp.name
-
-    clip.write_videofile(
-        temp_chunk_path,
-        codec="libx264",
-        audio_codec="aac",
-    )
-
-    vd = Video()
-    disk_writer = KeyFrameDiskWriter(location=keyframes_folder)
-
-    try:
-        extracted = vd.extract_video_keyframes(
-            no_of_frames=frames_to_extract,
-            file_path=temp_chunk_path,
-            writer=disk_writer,
-        )
-        if len(os.listdir(keyframes_folder)) == 0:
-            print(f"Fallback: Extracting random frame for chunk {chunk_index}")
-
-            # Load the temporary video chunk
-            chunk_clip = VideoFileClip(temp_chunk_path)
-            duration = chunk_clip.duration
-
-            if duration > 0:
-                random_time = random.uniform(0, duration)
-                frame = chunk_clip.get_frame(random_time)
-                image = Image.fromarray(np.uint8(frame))
+    keyframes = extract_chunk_frames(cursor, start_time, end_time, frames_to_extract)
+    for i, keyframe in enumerate(keyframes, start=1):
+        cv2.imwrite(os.path.join(keyframes_folder, f"keyframe_{i:02d}.jpg"), keyframe)
+
+    if not keyframes:
+        print(f"Fallback: Extracting random frame for chunk {chunk_index}")
+
+        if end_time > start_time:
+            random_time = random.uniform(start_time, end_time)
+            # The seek lands on the keyframe before random_time, so decode
+            # forward to it; if the chunk ends first, keep the last frame
+            # shown before end_time (the one on screen during the chunk).
+            cursor.seek(random_time)
+            frame = None
+            for decoded in cursor.frames():
+                if decoded.time is None:
+                    continue
+                if decoded.time >= end_time:
+                    cursor.push_back(decoded)
+                    break
+                frame = decoded
+                if decoded.time >= random_time:
+                    break
+            if frame is not None:
                 fallback_frame_path = os.path.join(keyframes_folder, f"fallback_frame.jpg")
-                image.save(fallback_frame_path)
+                cv2.imwrite(fallback_frame_path, frame.to_ndarray(format="bgr24"), [cv2.IMWRITE_JPEG_QUALITY, 90])
                 print(f"Saved fallback frame at {fallback_frame_path}")
 
-            chunk_clip.close()
-    finally:
-        if os.path.exists(temp_chunk_path):
-            os.remove(temp_chunk_path)
-
     info_path = os.path.join(chunk_folder, "_info.txt")
     with open(info_path, "w", encoding="utf-8") as info_file:
-        info_file.write(f"{sub.start} --> {sub.end}\n")
-        info_file.write(sub.text.strip() + "\n")
+        info_file.write(f"{format_srt_time(start_time)} --> {format_srt_time(end_time)}\n")
+        info_file.write(text.strip() + "\n")
+
+def process_video_with_srt(video_path, srt_path, output_dir, frames_to_extract=5, decoder_threads=0):
+    # Parse the whole transcript up front so a malformed file fails before
+    # any chunk folders are written
+    srt_blocks = parse_srt(srt_path)
 
-def process_video_with_srt(video_path, srt_path, output_dir, frames_to_extract=5):
     base_name = os.path.splitext(os.path.basename(video_path))[0]
     video_output_folder = os.path.join(output_dir, base_name)
     os.makedirs(video_output_folder, exist_ok=True)
 
-    subs = pysrt.open(srt_path)
-    video = VideoFileClip(video_path)
-
-    for i, sub in enumerate(subs, start=1):
-        start_time = srt_time_to_seconds(sub.start)
-        end_time = srt_time_to_seconds(sub.end)
-
-        chunk_clip = video.subclipped(start_time, end_time)
+    container = av.open(video_path)
+    stream = container.streams.video[0]
+    stream.thread_type = "AUTO"
+    # 0 lets FFmpeg pick one thread per core; callers running several
+    # videos in parallel pass their share of the cores instead
+    if decoder_threads:
+        stream.thread_count = decoder_threads
 
+    cursor = FrameCursor(container)
+    for i, (_, start_time, end_time, text) in enumerate(srt_blocks, start=1):
         process_subtitle_chunk(
-            clip=chunk_clip,
-            sub=sub,
+            cursor=cursor,
+            start_time=start_time,
+            end_time=end_time,
+            text=text,
             chunk_index=i,
             output_dir=video_output_folder,
             frames_to_extract=frames_to_extract,
         )
 
-    video.close()
+    container.close()
     print(f"Finished processing: {video_path}")
 
 
-def batch_process_videos(input_dir, output_dir="output", frames_to_extract=5):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def _process_one(video_file, input_dir, output_dir, frames_to_extract, decoder_threads):
+    base_name = os.path.splitext(video_file)[0]
+    srt_file = base_name + ".srt"
 
-    files = os.listdir(input_dir)
-    video_files = [f for f in files if f.lower().endswith(".mp4")]
+    video_path = os.path.join(input_dir, video_file)
+    srt_path = os.path.join(input_dir, srt_file)
 
-    for video_file in video_files:
-        base_name = os.path.splitext(video_file)[0]
-        srt_file = base_name + ".srt"
+    if not os.path.exists(srt_path):
+        print(f"Skipping '{video_file}': No matching .srt found.")
+        return
 
-        video_path = os.path.join(input_dir, video_file)
-        srt_path = os.path.join(input_dir, srt_file)
+    process_video_with_srt(
+        video_path=video_path,
+        srt_path=srt_path,
+        output_dir=output_dir,
+        frames_to_extract=frames_to_extract,
+        decoder_threads=decoder_threads,
+    )
 
-        if not os.path.exists(srt_path):
-            print(f"Skipping '{video_file}': No matching .srt found.")
-            continue
 
-        process_video_with_srt(
-            video_path=video_path,
-            srt_path=srt_path,
-            output_dir=output_dir,
-            frames_to_extract=frames_to_extract,
-        )
+def batch_process_videos(input_dir, output_dir="output", frames_to_extract=5):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    video_files = [
+        e.name for e in os.scandir(input_dir)
+        if e.is_file() and e.name.lower().endswith(".mp4")
+    ]
+    if not video_files:
+        return
+
+    # Videos are independent, so decode them in parallel worker processes and
+    # split the cores between them so the decoders don't oversubscribe the CPU
+    cpu_count = os.cpu_count() or 1
+    max_workers = min(len(video_files), cpu_count)
+    decoder_threads = max(1, cpu_count // max_workers) if max_workers > 1 else 0
+    worker = partial(
+        _process_one,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        frames_to_extract=frames_to_extract,
+        decoder_threads=decoder_threads,
+    )
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(worker, video_files))
 
 
 if __name__ == "__main__":
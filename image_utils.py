@@ -0,0 +1,160 @@
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+# Re-encoded copies live in a hidden subfolder so keyframe listings never pick them up
+SMALL_DIR_NAME = ".small"
+# Maximum number of reads submitted to the io_uring ring at once
+BATCH_READ_QUEUE_DEPTH = 64
+
+# One io_uring ring per thread, created on first use and reused afterwards
+_thread_state = threading.local()
+# Shared pool for the fallback path when io_uring is unavailable
+_read_executor = ThreadPoolExecutor(max_workers=8)
+
+def _small_path(image_path):
+    folder, file_name = os.path.split(image_path)
+    return os.path.join(folder, SMALL_DIR_NAME, os.path.splitext(file_name)[0] + ".jpg")
+
+def _is_fresh(small_path, image_path):
+    return os.path.exists(small_path) and os.path.getmtime(small_path) >= os.path.getmtime(image_path)
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _thread_ring():
+    ring = getattr(_thread_state, "ring", None)
+    if ring is None:
+        ring = liburing.io_uring()
+        liburing.io_uring_queue_init(BATCH_READ_QUEUE_DEPTH, ring, 0)
+        _thread_state.ring = ring
+        _thread_state.cqe = liburing.io_uring_cqe()
+    return ring, _thread_state.cqe
+
+def _drop_thread_ring():
+    ring = getattr(_thread_state, "ring", None)
+    if ring is not None:
+        _thread_state.ring = None
+        liburing.io_uring_queue_exit(ring)
+
+def _uring_read(paths):
+    ring, cqe = _thread_ring()
+    buffers = [None] * len(paths)
+    try:
+        for start in range(0, len(paths), BATCH_READ_QUEUE_DEPTH):
+            batch = range(start, min(start + BATCH_READ_QUEUE_DEPTH, len(paths)))
+            fds = {}
+            try:
+                # Open and size every file before touching the ring, so a
+                # failure here never leaves half a batch of SQEs queued
+                for i in batch:
+                    fds[i] = os.open(paths[i], os.O_RDONLY)
+                    buffers[i] = bytearray(os.fstat(fds[i]).st_size)
+
+                for i in batch:
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_read(sqe, fds[i], buffers[i], len(buffers[i]), 0)
+                    liburing.io_uring_sqe_set_data64(sqe, i)
+
+                # One submit for the whole batch, then reap every completion
+                # before raising: the kernel writes into `buffers` and reads
+                # `fds` until each CQE has been seen.
+                submitted = liburing.io_uring_submit(ring)
+                pending = submitted
+                errors = []
+                while pending:
+                    try:
+                        liburing.io_uring_wait_cqe(ring, cqe)
+                    except InterruptedError:
+                        continue
+                    i = cqe.user_data
+                    res = cqe.res
+                    liburing.io_uring_cqe_seen(ring, cqe)
+                    pending -= 1
+                    if res < 0:
+                        errors.append(OSError(-res, os.strerror(-res), paths[i]))
+                    elif res < len(buffers[i]):
+                        buffers[i] = _read_file(paths[i])
+
+                if errors:
+                    raise errors[0]
+                if submitted < len(batch):
+                    raise OSError(f"io_uring accepted only {submitted} of {len(batch)} reads")
+            finally:
+                for fd in fds.values():
+                    os.close(fd)
+    except BaseException:
+        # Tear the ring down so no unsubmitted SQE survives into the next call
+        _drop_thread_ring()
+        raise
+    return [bytes(buffer) for buffer in buffers]
+
+def batch_read(paths):
+    """
+    Read several files at once. On Linux with the `liburing` package the
+    reads are submitted in batches to a per-thread io_uring ring that is
+    reused across calls; otherwise they are spread over a shared thread pool.
+    """
+    if not paths:
+        return []
+
+    if liburing is not None and sys.platform.startswith("linux"):
+        try:
+            return _uring_read(paths)
+        except Exception as e:
+            print(f"io_uring read failed, falling back to threads: {e}")
+
+    return list(_read_executor.map(_read_file, paths))
+
+def resize_and_encode(image_path, max_side=1024, quality=75):
+    """
+    Downscale an image so its longest side is at most `max_side` and
+    re-encode it as JPEG. The result is cached on disk next to the source
+    and reused as long as it is newer than the source file.
+    """
+    small_path = _small_path(image_path)
+
+    if _is_fresh(small_path, image_path):
+        return _read_file(small_path)
+
+    with Image.open(image_path) as img:
+        # Let the JPEG decoder downscale while decoding when possible
+        img.draft("RGB", (max_side, max_side))
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    data = buffer.getvalue()
+
+    os.makedirs(os.path.dirname(small_path), exist_ok=True)
+    tmp_path = small_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, small_path)
+    return data
+
+def resize_and_encode_many(image_paths, max_side=1024, quality=75):
+    """
+    Same as `resize_and_encode` for a list of images; cached copies are
+    loaded together with `batch_read`.
+    """
+    small_paths = [_small_path(path) for path in image_paths]
+    fresh = [i for i, path in enumerate(image_paths) if _is_fresh(small_paths[i], path)]
+
+    results = [None] * len(image_paths)
+    for i, data in zip(fresh, batch_read([small_paths[i] for i in fresh])):
+        results[i] = data
+
+    for i, path in enumerate(image_paths):
+        if results[i] is None:
+            results[i] = resize_and_encode(path, max_side=max_side, quality=quality)
+    return results
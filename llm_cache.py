@@ -0,0 +1,65 @@
+import hashlib
+import inspect
+import pickle
+import functools
+import diskcache
+
+CACHE_DIR = "./.llm_cache"
+_cache = diskcache.Cache(CACHE_DIR)
+
+def _fingerprint(value):
+    # Raw image bytes are replaced by their digest so keys stay small
+    if isinstance(value, (bytes, bytearray)):
+        return hashlib.sha256(value).digest()
+    if isinstance(value, dict):
+        return tuple(sorted((k, _fingerprint(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_fingerprint(v) for v in value)
+    return value
+
+def cached_llm(model_name):
+    """
+    Cache the return value of an LLM call on disk, keyed by the model name,
+    the function source (so prompt edits invalidate old entries) and the
+    call arguments. Calls that raise are not cached. Works for both plain
+    and async functions.
+    """
+    def decorator(func):
+        source_digest = hashlib.sha256(inspect.getsource(func).encode("utf-8")).digest()
+
+        def make_key(args, kwargs):
+            return hashlib.sha256(pickle.dumps((
+                model_name,
+                func.__qualname__,
+                source_digest,
+                _fingerprint(args),
+                _fingerprint(kwargs),
+            ))).hexdigest()
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = make_key(args, kwargs)
+                cached = _cache.get(key)
+                if cached is not None:
+                    return cached
+
+                result = await func(*args, **kwargs)
+                _cache.set(key, result)
+                return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            cached = _cache.get(key)
+            if cached is not None:
+                return cached
+
+            result = func(*args, **kwargs)
+            _cache.set(key, result)
+            return result
+
+        return wrapper
+    return decorator
@@ -1,43 +1,90 @@
 import os
-import base64
+import pybase64
 import toml
 import openai
-import json
+import httpx
+import orjson
 import time
+import string
+import diskcache
+from functools import lru_cache
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from llm_cache import cached_llm
+from image_utils import resize_and_encode
 
 config = toml.load("secrets.toml")
 os.environ["OPENAI_API_KEY"] = config["OPENAI_API_KEY"]
 
-def encode_image(image_path):
-    with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
-
-def ask_logo_position(frame_b64, logo_b64):
+# Shared client so concurrent requests reuse pooled connections
+client = openai.OpenAI(
+    http_client=httpx.Client(limits=httpx.Limits(max_connections=32, max_keepalive_connections=32))
+)
+
+# Logo base64 payloads persist across runs, keyed by path and modification time
+b64_cache = diskcache.Cache("./.logo_b64_cache")
+
+@lru_cache(maxsize=4096)
+def encode_image(image_path, mtime):
+    key = ("image", os.path.abspath(image_path), mtime)
+    encoded = b64_cache.get(key)
+    if encoded is None:
+        with open(image_path, "rb") as f:
+            encoded = pybase64.b64encode(f.read()).decode("ascii")
+        b64_cache.set(key, encoded)
+    return encoded
+
+# Frames are visited once per run and their downscaled JPEG is already
+# cached on disk by resize_and_encode, so only the encode happens here
+def encode_frame(frame_path):
+    return pybase64.b64encode(resize_and_encode(frame_path)).decode("ascii")
+
+def logo_label(index):
+    return string.ascii_uppercase[index] if index < len(string.ascii_uppercase) else f"L{index + 1}"
+
+@cached_llm("gpt-4o")
+def query_logo_positions(frame_b64, logo_items):
+    labels = [logo_label(i) for i in range(len(logo_items))]
+    content = [
+        {
+            "type": "text",
+            "text": (
+                f"For each of the following {len(logo_items)} reference logos (labeled {', '.join(labels)}), "
+                "does the keyframe image contain the same logo? "
+                "If yes, give its position: top-left, bottom-right, center, etc. "
+                "Reply only with a JSON object mapping each label to its position or \"no\", "
+                f"for example {{\"{labels[0]}\": \"top-left\"}}."
+            )
+        },
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{frame_b64}" }},
+    ]
+    for label, (_, logo_b64) in zip(labels, logo_items):
+        content.append({"type": "text", "text": f"Reference logo {label}:"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{logo_b64}" }})
+
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=[{"role": "user", "content": content}],
+        response_format={"type": "json_object"},
+        max_tokens=50 + 20 * len(logo_items),
+    )
+    answers = orjson.loads(response.choices[0].message.content)
+    return [answers.get(label, "no") for label in labels]
+
+def ask_logo_position(frame_b64, logo_items):
+    if not logo_items:
+        return None
     for attempt in range(3):
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "user", "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                "Does the keyframe image contain the same logo as the reference image? "
-                                "If yes, give its position: top-left, bottom-right, center, etc. "
-                                "If no logo is found, reply only 'No'."
-                            )
-                        },
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{frame_b64}" }},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{logo_b64}" }}
-                    ]}
-                ],
-                max_tokens=100,
-            )
-            content = response.choices[0].message.content.strip()
-            if content.lower() == "no":
-                return None
-            return content
+            for position in query_logo_positions(frame_b64, logo_items):
+                # Only a non-empty string other than "no" counts as a hit;
+                # null, false or any other JSON value means "no"
+                if not isinstance(position, str):
+                    continue
+                position = position.strip()
+                if position and position.lower().rstrip(".") != "no":
+                    return position
+            return None
         except Exception as e:
             print(f"⚠️ Error on attempt {attempt + 1}: {e}")
             time.sleep(2)
@@ -45,24 +92,24 @@ def ask_logo_position(frame_b64, logo_b64):
 
 logo_folder = "logo"
 logo_images = {}
-for logo_file in os.listdir(logo_folder):
-    if logo_file.lower().endswith((".jpg", ".jpeg", ".png")):
-        logo_path = os.path.join(logo_folder, logo_file)
-        logo_images[logo_file] = encode_image(logo_path)
+for entry in os.scandir(logo_folder):
+    if entry.is_file() and entry.name.lower().endswith((".jpg", ".jpeg", ".png")):
+        logo_images[entry.name] = encode_image(entry.path, entry.stat().st_mtime)
+logo_items = list(logo_images.items())
 
 frames_root = "frames"
 final_results = []
+executor = ThreadPoolExecutor(max_workers=16)
 
-
-for video_name in sorted(os.listdir(frames_root)):
-    video_path = os.path.join(frames_root, video_name)
-    if not os.path.isdir(video_path):
-        continue
+video_entries = sorted((e for e in os.scandir(frames_root) if e.is_dir()), key=lambda e: e.name)
+for video_entry in video_entries:
+    video_name = video_entry.name
+    video_path = video_entry.path
 
     print(f"Processing video: {video_name}")
 
-    for chunk_name in sorted(os.listdir(video_path)):
-        chunk_path = os.path.join(video_path, chunk_name)
+    chunk_paths = sorted(e.path for e in os.scandir(video_path) if e.is_dir())
+    for chunk_path in chunk_paths:
         keyframe_dir = os.path.join(chunk_path, "keyframes")
         transcript_path = os.path.join(chunk_path, "_info.txt")
 
@@ -81,27 +128,31 @@ for video_name in sorted(os.listdir(frames_root)):
                 if lines:
                     chunk_result["timestamp"] = lines[0].strip()
 
-        found = False
-        for frame_file in sorted(os.listdir(keyframe_dir)):
-            if not frame_file.lower().endswith((".jpg", ".jpeg", ".png")):
-                continue
-
-            frame_path = os.path.join(keyframe_dir, frame_file)
-            frame_b64 = encode_image(frame_path)
-
-            for logo_name, logo_b64 in logo_images.items():
-                position = ask_logo_position(frame_b64, logo_b64)
-                if position:
-                    chunk_result["logo_position"] = position
-                    found = True
-                    break
-
-            if found:
+        futures = []
+        frame_entries = sorted(
+            (
+                e for e in os.scandir(keyframe_dir)
+                if e.is_file() and e.name.lower().endswith((".jpg", ".jpeg", ".png"))
+            ),
+            key=lambda e: e.name,
+        )
+        for frame_entry in frame_entries:
+            frame_b64 = encode_frame(frame_entry.path)
+            futures.append(executor.submit(ask_logo_position, frame_b64, logo_items))
+
+        for future in as_completed(futures):
+            position = future.result()
+            if position:
+                chunk_result["logo_position"] = position
+                for pending in futures:
+                    pending.cancel()
                 break
 
         if chunk_result["logo_position"] != "No.":
             final_results.append(chunk_result)
 
+executor.shutdown(wait=True)
+
 video_results = defaultdict(list)
 for result in final_results:
     video_results[result["video"]].append(result)
@@ -112,8 +163,8 @@ os.makedirs(output_folder, exist_ok=True)
 for video_name, chunks in video_results.items():
     safe_name = video_name.replace(" ", "_").replace("/", "_")
     output_path = os.path.join(output_folder, f"{safe_name}_logo_results.json")
-    with open(output_path, "w") as f:
-        json.dump(chunks, f, indent=2)
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(chunks, option=orjson.OPT_INDENT_2))
     print(f"Saved logo results for `{video_name}` to `{output_path}`")
 
 print(f"Completed. {len(video_results)} video report(s) saved in `{output_folder}`.")
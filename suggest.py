@@ -1,15 +1,22 @@
 import os
 import re
-import json
+import orjson
 import toml
 import argparse
 import base64
+import random
+import asyncio
 import google.generativeai as genai
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.api_core.exceptions import ResourceExhausted
+from llm_cache import cached_llm
+from image_utils import resize_and_encode_many
 
 config = toml.load("secrets.toml")
 genai.configure(api_key=config["GEMINI_API_KEY"])
 
+MODEL_NAME = "gemini-2.5-pro-exp-03-25"
+_MODEL = genai.GenerativeModel(MODEL_NAME)
+
 parser = argparse.ArgumentParser(description="Generate instructional quality reports from video chunk folders.")
 parser.add_argument("--input_dir", type=str, default="frames", help="Path to parent input directory (e.g., 'output')")
 parser.add_argument("--output_dir", type=str, default="reports", help="Path to parent output directory (e.g., 'reports')")
@@ -19,6 +26,15 @@ parent_input_dir = args.input_dir
 parent_report_dir = args.output_dir
 os.makedirs(parent_report_dir, exist_ok=True)
 
+_JSON_OPEN = re.compile(r"^```json\s*")
+_JSON_CLOSE = re.compile(r"\s*```$")
+
+# Number of chunks packed into a single Gemini request
+CHUNK_BATCH_SIZE = 5
+# Upper bound on in-flight Gemini requests
+MAX_CONCURRENT_REQUESTS = 20
+MAX_RETRIES = 5
+
 def parse_time_to_seconds(timestr):
     timestr = timestr.replace(',', '.')
     h, m, s = timestr.split(':')
@@ -33,22 +49,42 @@ def parse_timestamp_range(range_str):
 def load_keyframe_images(directory, max_images=5):
     if not os.path.exists(directory):
         return []
-    image_files = sorted(
-        [f for f in os.listdir(directory) if f.lower().endswith(('.jpg', '.jpeg'))]
+    image_paths = sorted(
+        [
+            e.path for e in os.scandir(directory)
+            if e.is_file() and e.name.lower().endswith(('.jpg', '.jpeg'))
+        ]
     )[:max_images]
 
     images = []
-    for f in image_files:
-        with open(os.path.join(directory, f), "rb") as img_file:
-            images.append({
-                "mime_type": "image/jpeg",
-                "data": img_file.read()
-            })
+    for data in resize_and_encode_many(image_paths):
+        images.append({
+            "mime_type": "image/jpeg",
+            "data": data
+        })
     return images
 
+def strip_json_fences(raw_content):
+    if raw_content.startswith("```json"):
+        raw_content = _JSON_OPEN.sub("", raw_content)
+        raw_content = _JSON_CLOSE.sub("", raw_content)
+    return raw_content
 
-def generate_instructional_quality_report(subtitles, images, timestamp_range):
-    model = genai.GenerativeModel("gemini-2.5-pro-exp-03-25")
+# Retry rate-limited (HTTP 429) calls with exponential backoff and jitter
+async def generate_with_backoff(model, contents):
+    delay = 2
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await model.generate_content_async(contents)
+        except ResourceExhausted:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(delay + random.uniform(0, 1))
+            delay *= 2
+
+
+@cached_llm(MODEL_NAME)
+async def generate_instructional_quality_report(subtitles, images, timestamp_range):
     prompt = (
         "You are an expert video quality analyst.\n"
         "Evaluate the given video chunk using keyframe images and subtitles. Use these categories:\n"
@@ -60,26 +96,60 @@ def generate_instructional_quality_report(subtitles, images, timestamp_range):
     )
 
     try:
-        response = model.generate_content([
+        response = await generate_with_backoff(_MODEL, [
             prompt,
             f"Subtitles:\n{subtitles}",
             *images
         ])
-        raw_content = response.text.strip()
-
-        if raw_content.startswith("```json"):
-            raw_content = re.sub(r"^```json\s*", "", raw_content)
-            raw_content = re.sub(r"\s*```$", "", raw_content)
+        raw_content = strip_json_fences(response.text.strip())
 
-        report_json = json.loads(raw_content)
+        report_json = orjson.loads(raw_content)
         report_json["timestamp"] = timestamp_range
-        return json.dumps(report_json, indent=2)
+        return orjson.dumps(report_json, option=orjson.OPT_INDENT_2).decode()
 
     except Exception as e:
         raise RuntimeError(f"Gemini generation error: {e}")
 
-def generate_suggestions_for_whole_video(report_data):
-    model = genai.GenerativeModel("gemini-2.5-pro-exp-03-25")
+# Evaluate several chunks in one Gemini call; returns one report body per chunk
+@cached_llm(MODEL_NAME)
+async def generate_batch_quality_report(chunks):
+    prompt = (
+        "You are an expert video quality analyst.\n"
+        f"Evaluate each of the following {len(chunks)} video chunks using its keyframe images and subtitles. "
+        "Use these categories:\n"
+        "1) Signaling\n2) Weeding\n3) Matching Modality\n4) Visual Quality\n"
+        "5) Consistency\n6) Accessibility\n7) Technical Quality\n\n"
+        "Score each category from 1 to 3 and give detailed improvement suggestions.\n\n"
+        f"Return ONLY a valid JSON array of {len(chunks)} objects, one per chunk and in the same order, each in this format:\n"
+        "{ \"summary\": \"...\", \"evaluation\": { \"Signaling\": {\"score\": ..., \"comment\": \"...\"}, ... }, \"timestamp\": \"...\" }"
+    )
+
+    contents = [prompt]
+    for i, chunk in enumerate(chunks, start=1):
+        contents.append(f"--- Chunk {i} ({chunk['timestamp_range']}) ---")
+        contents.append(f"Chunk {i} subtitles:\n{chunk['subtitles']}")
+        contents.extend(chunk["images"])
+    contents.append("--- End of chunks ---")
+
+    try:
+        response = await generate_with_backoff(_MODEL, contents)
+        raw_content = strip_json_fences(response.text.strip())
+
+        reports = orjson.loads(raw_content)
+        if not isinstance(reports, list) or len(reports) != len(chunks):
+            raise ValueError(f"expected a JSON array of {len(chunks)} reports")
+
+        report_bodies = []
+        for chunk, report_json in zip(chunks, reports):
+            report_json["timestamp"] = chunk["timestamp_range"]
+            report_bodies.append(orjson.dumps(report_json, option=orjson.OPT_INDENT_2).decode())
+        return report_bodies
+
+    except Exception as e:
+        raise RuntimeError(f"Gemini batch generation error: {e}")
+
+@cached_llm(MODEL_NAME)
+async def generate_suggestions_for_whole_video(report_data):
     prompt = (
         "You are a video quality expert. Based on the following chunk evaluations (score 1-3), identify which chunks need improvement.\n\n"
         "Return a JSON array with:\n"
@@ -89,73 +159,122 @@ def generate_suggestions_for_whole_video(report_data):
     )
 
     try:
-        response = model.generate_content([
+        response = await generate_with_backoff(_MODEL, [
             prompt,
-            f"{json.dumps(report_data)}"
+            orjson.dumps(report_data).decode()
         ])
-        raw_output = response.text.strip()
+        raw_output = strip_json_fences(response.text.strip())
 
-        if raw_output.startswith("```json"):
-            raw_output = re.sub(r"^```json\s*", "", raw_output)
-            raw_output = re.sub(r"\s*```$", "", raw_output)
-
-        return json.loads(raw_output)
+        return orjson.loads(raw_output)
 
     except Exception as e:
         raise RuntimeError(f"Gemini suggestion generation error: {e}")
 
 
-# Process each chunk folder (info.txt + keyframes)
-def process_chunk_folder(chunk_folder):
-    chunk_name = os.path.basename(chunk_folder)
+# Load a chunk folder (info.txt + keyframes)
+def load_chunk_folder(chunk_folder):
     info_path = os.path.join(chunk_folder, "_info.txt")
     keyframe_dir = os.path.join(chunk_folder, "keyframes")
 
     if not os.path.exists(info_path):
-        return {"status": "error", "chunk_name": chunk_name, "message": "_info.txt missing"}
+        raise FileNotFoundError("_info.txt missing")
+
+    with open(info_path, "r", encoding="utf-8") as f:
+        lines = f.read().strip().splitlines()
+
+    if len(lines) < 2:
+        raise ValueError("Not enough data in _info.txt")
+
+    timestamp_range = lines[0].strip()
+    subtitles_text = " ".join(line.strip() for line in lines[1:])
+    start_sec, end_sec = parse_timestamp_range(timestamp_range)
+    images = load_keyframe_images(keyframe_dir)
+
+    if not images:
+        raise FileNotFoundError("No keyframes found")
+
+    return {
+        "chunk_name": os.path.basename(chunk_folder),
+        "start_sec": start_sec,
+        "end_sec": end_sec,
+        "timestamp_range": timestamp_range,
+        "subtitles": subtitles_text,
+        "images": images
+    }
+
+
+def chunk_result(chunk, report_body):
+    return {
+        "status": "success",
+        "chunk_name": chunk["chunk_name"],
+        "start_sec": chunk["start_sec"],
+        "end_sec": chunk["end_sec"],
+        "timestamp_range": chunk["timestamp_range"],
+        "report_body": report_body
+    }
+
+
+# Process a batch of chunk folders with a single Gemini call
+async def process_chunk_batch(chunk_folders):
+    results = []
+    chunks = []
+    for chunk_folder in chunk_folders:
+        try:
+            chunks.append(await asyncio.to_thread(load_chunk_folder, chunk_folder))
+        except Exception as e:
+            results.append({"status": "error", "chunk_name": os.path.basename(chunk_folder), "message": str(e)})
+
+    if not chunks:
+        return results
 
     try:
-        with open(info_path, "r", encoding="utf-8") as f:
-            lines = f.read().strip().splitlines()
+        report_bodies = await generate_batch_quality_report(chunks)
+        results.extend(chunk_result(chunk, body) for chunk, body in zip(chunks, report_bodies))
+        return results
+    except Exception as e:
+        print(f"Batch of {len(chunks)} chunks failed, retrying individually: {e}")
 
-        if len(lines) < 2:
-            raise ValueError("Not enough data in _info.txt")
+    # Fall back to one request per chunk if the batched response was unusable
+    for chunk in chunks:
+        try:
+            report_body = await generate_instructional_quality_report(
+                subtitles=chunk["subtitles"],
+                images=chunk["images"],
+                timestamp_range=chunk["timestamp_range"]
+            )
+            results.append(chunk_result(chunk, report_body))
+        except Exception as e:
+            results.append({"status": "error", "chunk_name": chunk["chunk_name"], "message": str(e)})
+    return results
 
-        timestamp_range = lines[0].strip()
-        subtitles_text = " ".join(line.strip() for line in lines[1:])
-        start_sec, end_sec = parse_timestamp_range(timestamp_range)
-        images = load_keyframe_images(keyframe_dir)
 
-        if not images:
-            raise FileNotFoundError("No keyframes found")
+# Run all batches of a video concurrently, bounded by MAX_CONCURRENT_REQUESTS
+async def process_video_chunks(chunk_folders):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-        report_body = generate_instructional_quality_report(
-            subtitles=subtitles_text,
-            images=images,
-            timestamp_range=timestamp_range
-        )
+    async def run_batch(batch):
+        async with semaphore:
+            return await process_chunk_batch(batch)
 
-        return {
-            "status": "success",
-            "chunk_name": chunk_name,
-            "start_sec": start_sec,
-            "end_sec": end_sec,
-            "timestamp_range": timestamp_range,
-            "report_body": report_body
-        }
+    batches = [
+        chunk_folders[i:i + CHUNK_BATCH_SIZE]
+        for i in range(0, len(chunk_folders), CHUNK_BATCH_SIZE)
+    ]
 
-    except Exception as e:
-        return {"status": "error", "chunk_name": chunk_name, "message": str(e)}
+    results = []
+    for next_batch in asyncio.as_completed([run_batch(batch) for batch in batches]):
+        for result in await next_batch:
+            if result["status"] == "error":
+                print(f"Error in {result['chunk_name']}: {result['message']}")
+            else:
+                print(f"Done: {result['chunk_name']}")
+            results.append(result)
+    return results
 
 
-# Main Runner
-if __name__ == "__main__":
+async def main():
     video_folders = sorted(
-        [
-            os.path.join(parent_input_dir, f)
-            for f in os.listdir(parent_input_dir)
-            if os.path.isdir(os.path.join(parent_input_dir, f))
-        ]
+        [e.path for e in os.scandir(parent_input_dir) if e.is_dir()]
     )
 
     for video_dir in video_folders:
@@ -167,38 +286,32 @@ if __name__ == "__main__":
 
         print(f"\nProcessing {video_id}...")
 
-        all_entries = os.listdir(video_dir)
         chunk_folders = sorted(
             [
-                os.path.join(video_dir, d)
-                for d in all_entries
-                if d.lower().startswith("chunk_") and os.path.isdir(os.path.join(video_dir, d))
+                e.path for e in os.scandir(video_dir)
+                if e.name.lower().startswith("chunk_") and e.is_dir()
             ]
         )
 
-        results = []
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [executor.submit(process_chunk_folder, folder) for folder in chunk_folders]
-            for future in as_completed(futures):
-                result = future.result()
-                if result["status"] == "error":
-                    print(f"Error in {result['chunk_name']}: {result['message']}")
-                else:
-                    print(f"Done: {result['chunk_name']}")
-                results.append(result)
+        results = await process_video_chunks(chunk_folders)
 
         successful_results = [r for r in results if r["status"] == "success"]
         successful_results.sort(key=lambda r: r["start_sec"])
-        combined_json = [json.loads(item["report_body"]) for item in successful_results]
+        combined_json = [orjson.loads(item["report_body"]) for item in successful_results]
 
-        with open(single_report_path, "w", encoding="utf-8") as out_file:
-            json.dump(combined_json, out_file, indent=2)
+        with open(single_report_path, "wb") as out_file:
+            out_file.write(orjson.dumps(combined_json, option=orjson.OPT_INDENT_2))
         print(f"Report saved: {single_report_path}")
 
         try:
-            suggestions = generate_suggestions_for_whole_video(combined_json)
-            with open(suggestions_output_path, "w", encoding="utf-8") as out_file:
-                json.dump(suggestions, out_file, indent=2)
+            suggestions = await generate_suggestions_for_whole_video(combined_json)
+            with open(suggestions_output_path, "wb") as out_file:
+                out_file.write(orjson.dumps(suggestions, option=orjson.OPT_INDENT_2))
             print(f"Suggestions saved: {suggestions_output_path}")
         except Exception as e:
             print(f"Failed to generate suggestions for {video_id}: {e}")
+
+
+# Main Runner
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,27 +1,36 @@
 # %%
 import os
 import re
+import mmap
 import argparse
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
+
+# One SRT block: index line, "HH:MM:SS,mmm --> HH:MM:SS,mmm" line, then
+# subtitle lines up to the next blank line. "." is accepted as the
+# milliseconds separator as well, spaces around the arrow are optional,
+# a cue may have no text and a leading UTF-8 BOM is skipped.
+_SRT_BLOCK = re.compile(
+    rb"^(?:\xef\xbb\xbf)?[ \t]*(\d+)[ \t]*\r?\n"
+    rb"[ \t]*(\d+):(\d\d):(\d\d)[,.](\d{3})[ \t]*-->[ \t]*(\d+):(\d\d):(\d\d)[,.](\d{3})[^\r\n]*(?:\r?\n|\Z)"
+    rb"((?:[ \t]*\S[^\r\n]*(?:\r?\n|\Z))*)",
+    re.M,
+)
+
+# Anything with a timestamp or an arrow is treated as a cue
+_CUE_LIKE = re.compile(rb"\d+:\d\d:\d\d|-->")
+
+_WS = re.compile(r"\s+")
+_PUNCT_TABLE = str.maketrans("“”‘’—–", "\"\"''--")
 
 def normalize_text(txt: str) -> str:
     """
     Normalize text so that common punctuation and whitespace differences
     don't break matching.
     """
-    txt = txt.replace("“", '"').replace("”", '"')
-    txt = txt.replace("‘", "'").replace("’", "'")
-    txt = txt.replace("—", "-").replace("–", "-")
-    txt = re.sub(r"\s+", " ", txt)
+    txt = txt.translate(_PUNCT_TABLE)
+    txt = _WS.sub(" ", txt)
     return txt.strip()
 
-def parse_srt_time(timestr: str) -> float:
-    """Convert 'HH:MM:SS,mmm' -> total seconds as float."""
-    hours, minutes, seconds_milli = timestr.split(':')
-    seconds, millis = seconds_milli.split(',')
-    total_seconds = int(hours)*3600 + int(minutes)*60 + int(seconds) + float(millis)/1000
-    return total_seconds
-
 def format_srt_time(total_seconds: float) -> str:
     """Convert total seconds (float) -> 'HH:MM:SS,mmm' string."""
     hours = int(total_seconds // 3600)
@@ -31,39 +40,44 @@ def format_srt_time(total_seconds: float) -> str:
     millis = int(round((total_seconds - int(total_seconds)) * 1000))
     return f"{hours:02d}:{minutes:02d}:{seconds:02d},{millis:03d}"
 
+def _check_unmatched(srt_path: str, span: bytes):
+    """
+    Make sure text between parsed blocks is not silently dropped: raise if it
+    looks like a cue the pattern failed to parse, warn on other stray text.
+    """
+    if not span.strip():
+        return
+    snippet = span.strip().decode('utf-8', errors='replace').splitlines()[0]
+    if _CUE_LIKE.search(span):
+        raise ValueError(f"Malformed SRT block in '{srt_path}' near: {snippet!r}")
+    print(f"Ignoring unexpected text in '{srt_path}': {snippet!r}")
+
+def iter_srt(srt_path: str) -> Iterator[Tuple[int, float, float, str]]:
+    """
+    Lazily yield SRT blocks from a memory-mapped file as tuples:
+      (block_index, start_time_seconds, end_time_seconds, text_combined).
+    """
+    if os.path.getsize(srt_path) == 0:
+        return
+
+    with open(srt_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        prev_end = 0
+        for match in _SRT_BLOCK.finditer(buf):
+            _check_unmatched(srt_path, buf[prev_end:match.start()])
+            prev_end = match.end()
+            index, sh, sm, ss, sms, eh, em, es, ems, text = match.groups()
+            start_seconds = int(sh)*3600 + int(sm)*60 + int(ss) + int(sms)/1000
+            end_seconds = int(eh)*3600 + int(em)*60 + int(es) + int(ems)/1000
+            combined_text = " ".join(ln.strip() for ln in text.decode('utf-8').splitlines()).strip()
+            yield (int(index), start_seconds, end_seconds, combined_text)
+        _check_unmatched(srt_path, buf[prev_end:])
+
 def parse_srt(srt_path: str) -> List[Tuple[int, float, float, str]]:
     """
     Parse an SRT file into a list of tuples:
       (block_index, start_time_seconds, end_time_seconds, text_combined).
     """
-    blocks = []
-    with open(srt_path, 'r', encoding='utf-8') as f:
-        content = f.read().strip()
-
-    raw_blocks = re.split(r'\n\s*\n', content)
-    for block in raw_blocks:
-        lines = block.strip().splitlines()
-        if not lines:
-            continue
-
-        # First line: block index
-        index_str = lines[0].strip()
-        if not index_str.isdigit():
-            continue
-        block_index = int(index_str)
-
-        # Second line: "HH:MM:SS,mmm --> HH:MM:SS,mmm"
-        time_line = lines[1].strip()
-        start_str, _, end_str = time_line.split()
-        start_seconds = parse_srt_time(start_str)
-        end_seconds = parse_srt_time(end_str)
-
-        # Remaining lines: subtitle text
-        subtitle_lines = lines[2:]
-        combined_text = " ".join(ln.strip() for ln in subtitle_lines).strip()
-
-        blocks.append((block_index, start_seconds, end_seconds, combined_text))
-    return blocks
+    return list(iter_srt(srt_path))
 
 def load_paragraphs_from_docx(docx_path: str) -> List[str]:
     """Load paragraphs from a DOCX file."""
@@ -85,39 +99,46 @@ def merge_srt_by_paragraph(
     srt_i = 0
     n_srt = len(srt_blocks)
 
+    # Normalizing each block once lets the matcher work on the normalized
+    # pieces directly instead of re-normalizing accumulated text.
+    srt_blocks_norm = [normalize_text(text) for _, _, _, text in srt_blocks]
+
     for paragraph in paragraphs:
         paragraph_norm = normalize_text(paragraph)
+        paragraph_len = len(paragraph_norm)
 
-        accumulated_text = ""
+        # Length of the paragraph prefix matched by the blocks taken so far
+        accum_len = 0
         start_time = None
         end_time = None
 
         start_srt_i = srt_i
 
         while srt_i < n_srt:
-            _, block_start, block_end, block_text = srt_blocks[srt_i]
+            _, block_start, block_end, _ = srt_blocks[srt_i]
+            block_norm = srt_blocks_norm[srt_i]
 
             if start_time is None:
                 start_time = block_start
             end_time = block_end
 
-            if accumulated_text:
-                accumulated_text += " " + block_text
+            if accum_len and block_norm:
+                piece = " " + block_norm
             else:
-                accumulated_text = block_text
+                piece = block_norm
 
-            accum_norm = normalize_text(accumulated_text)
+            # Earlier pieces already matched, so only the new piece is compared
+            if not paragraph_norm.startswith(piece, accum_len):
+                srt_i = start_srt_i
+                break
 
-            if accum_norm == paragraph_norm:
+            accum_len += len(piece)
+            if accum_len == paragraph_len:
                 merged.append((current_index, start_time, end_time, paragraph))
                 current_index += 1
                 srt_i += 1
                 break
-            elif paragraph_norm.startswith(accum_norm):
-                srt_i += 1
-            else:
-                srt_i = start_srt_i
-                break
+            srt_i += 1
 
     return merged
 
@@ -137,9 +158,16 @@ def process_folder(folder_path: str):
     For each matching .srt/.docx pair in `folder_path`, merge them and overwrite
     the original .srt with the merged content.
     """
-    all_files = os.listdir(folder_path)
-    srt_files = {f for f in all_files if f.lower().endswith(".srt")}
-    docx_files = {f for f in all_files if f.lower().endswith(".docx")}
+    srt_files = set()
+    docx_files = set()
+    for entry in os.scandir(folder_path):
+        if not entry.is_file():
+            continue
+        name_lower = entry.name.lower()
+        if name_lower.endswith(".srt"):
+            srt_files.add(entry.name)
+        elif name_lower.endswith(".docx"):
+            docx_files.add(entry.name)
 
     for srt_file in srt_files:
         base_name, _ = os.path.splitext(srt_file)